@@ -1,4 +1,6 @@
 import os
+import copy
+import shutil
 import numpy as np
 import json
 import torch
@@ -14,6 +16,7 @@ import torch.utils.data
 from cococaption.pycocotools.coco import COCO
 from cococaption.pycocoevalcap.eval import COCOEvalCap
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 
 class COCOTrainDataset(Dataset):
@@ -23,22 +26,17 @@ class COCOTrainDataset(Dataset):
         # Captions per image
         self.cpi = 5
 
-        # Load encoded captions (completely into memory)
-        with open(os.path.join('caption data','TRAIN_CAPTIONS_coco.json'), 'r') as j:
-            self.captions = json.load(j)
-
-        # Load caption lengths (completely into memory)
-        with open(os.path.join('caption data', 'TRAIN_CAPLENS_coco.json'), 'r') as j:
-            self.caplens = json.load(j)
+        # The caption data is flattened into int16 arrays by preprocess_npy.py. Memory-map them rather than 
+        # loading them, so that all DataLoader workers share the same pages
+        self.captions_arr = np.load(os.path.join('caption data', 'TRAIN_CAPTIONS_coco.npy'), mmap_mode='r')   # (num_captions, max_length)
+        self.caplens_arr = np.load(os.path.join('caption data', 'TRAIN_CAPLENS_coco.npy'), mmap_mode='r')     # (num_captions)
         
-        with open('caption data/TRAIN_names_coco.json', 'r') as j:
-            self.names = json.load(j)
-            
-        with open('caption data/CAPUTIL_train.json', 'r') as j:
-            self.caption_util = json.load(j)
+        # Previous captions are indexed by image position (in the order of TRAIN_names_coco.json) instead of by image name
+        self.prev_caps_arr = np.load(os.path.join('caption data', 'TRAIN_PREVCAPS_coco.npy'), mmap_mode='r')          # (num_images, max_length)
+        self.prev_caplens_arr = np.load(os.path.join('caption data', 'TRAIN_PREVCAPLENS_coco.npy'), mmap_mode='r')    # (num_images, 1)
 
         # Total number of datapoints
-        self.dataset_size = len(self.captions)
+        self.dataset_size = len(self.captions_arr)
 
     def __getitem__(self, i):
         """
@@ -49,14 +47,15 @@ class COCOTrainDataset(Dataset):
         previous_caption_length: the valid length (without padding) of the previous caption of shape (batch_size,1)
         """
         # The Nth caption corresponds to the (N // captions_per_image)th image
-        img_name = self.names[i // self.cpi]
+        img_idx = i // self.cpi
+        base = img_idx * self.cpi
         
-        caption = torch.LongTensor(self.captions[i])
-        caplen = torch.LongTensor([self.caplens[i]])
+        caption = torch.from_numpy(self.captions_arr[i].astype(np.int64))
+        caplen = torch.from_numpy(self.caplens_arr[i:i + 1].astype(np.int64))
         
-        previous_caption = torch.LongTensor(self.caption_util[img_name]['encoded_previous_caption'])
-        prev_caplen = torch.LongTensor(self.caption_util[img_name]['previous_caption_length'])
-        all_captions = torch.LongTensor(self.captions[((i // self.cpi) * self.cpi):(((i // self.cpi) * self.cpi) + self.cpi)])
+        previous_caption = torch.from_numpy(self.prev_caps_arr[img_idx].astype(np.int64))
+        prev_caplen = torch.from_numpy(self.prev_caplens_arr[img_idx].astype(np.int64))
+        all_captions = torch.from_numpy(self.captions_arr[base:base + self.cpi].astype(np.int64))
         
         return caption, caplen, previous_caption, prev_caplen, all_captions
 
@@ -98,20 +97,56 @@ class COCOValidationDataset(Dataset):
         return self.dataset_size
 
 
+# Checkpoints are written in the background so that training can continue during the save
+checkpoint_executor = ThreadPoolExecutor(max_workers = 1)
+checkpoint_future = None
+
+def write_checkpoint(state, filename, is_best):
+    
+    torch.save(state, filename)
+    # If this checkpoint is the best so far, store a copy so it doesn't get overwritten by a worse checkpoint
+    if is_best:
+        shutil.copyfile(filename, 'BEST_' + filename)
+
 def save_checkpoint(epoch, epochs_since_improvement, dae_mse, dae_mse_optimizer, cider, is_best):
+    
+    global checkpoint_future
+    # Wait for the previous checkpoint, so that at most one snapshot is held in memory
+    if checkpoint_future is not None:
+        checkpoint_future.result()
 
     state = {'epoch': epoch,
              'epochs_since_improvement': epochs_since_improvement,
              'cider': cider,
              'dae_mse': dae_mse,
              'dae_mse_optimizer': dae_mse_optimizer}
+    # Snapshot the model and the optimizer on the CPU before training modifies them again. The memo makes deepcopy use 
+    # CPU copies of the parameters, buffers and optimizer state instead of copying them on the GPU, and since it is a 
+    # single deepcopy the copied optimizer still refers to the copied parameters
+    memo = {}
+    for p in dae_mse.parameters():
+        memo[id(p)] = nn.Parameter(p.detach().to('cpu', copy=True), requires_grad=p.requires_grad)
+    for b in dae_mse.buffers():
+        memo[id(b)] = b.to('cpu', copy=True)
+    for param_state in dae_mse_optimizer.state.values():
+        for v in param_state.values():
+            if torch.is_tensor(v):
+                memo[id(v)] = v.to('cpu', copy=True)
+    state = copy.deepcopy(state, memo)
     
     filename = 'checkpoint_' + str(epoch) + '.pth.tar'
-    torch.save(state, filename)
-    # If this checkpoint is the best so far, store a copy so it doesn't get overwritten by a worse checkpoint
-    if is_best:
-        torch.save(state, 'BEST_' + filename)
+    checkpoint_future = checkpoint_executor.submit(write_checkpoint, state, filename, is_best)
         
+def optimizer_to(optimizer, device):
+    """
+    Move the optimizer state (e.g. the Adam moments) to device, as checkpoints store it on the CPU. 
+    Like Optimizer.load_state_dict, the 'step' counters are left where they are
+    """
+    for param_state in optimizer.state.values():
+        for key, value in param_state.items():
+            if torch.is_tensor(value) and key != 'step':
+                param_state[key] = value.to(device)
+
 def set_learning_rate(optimizer, lr):
 
     for param_group in optimizer.param_groups:
@@ -164,14 +199,15 @@ class Embedding(nn.Module):
         torch.nn.init.uniform_(embeddings, -bias, bias)   # initialize embeddings. Unfound words in the word_map are initialized
 
         # Read embedding file
-        for line in open(self.emb_file, 'r', encoding="utf8"):
-            line = line.split(' ')
-            emb_word = line[0]
-            embedded_word = list(map(lambda t: float(t), filter(lambda n: n and not n.isspace(), line[1:])))
-            # Ignore word if not in vocab
-            if emb_word not in vocab:
-                continue   # go back and continue the loop
-            embeddings[self.word_map[emb_word]] = torch.FloatTensor(embedded_word)
+        with open(self.emb_file, 'r', encoding="utf8") as f:
+            for line in f:
+                emb_word, _, values = line.rstrip().partition(' ')
+                # Ignore word if not in vocab
+                if emb_word not in vocab:
+                    continue   # go back and continue the loop
+                # Parse the vector in C rather than float()-ing each value in Python
+                embedded_word = np.fromstring(values, dtype=np.float32, sep=' ')
+                embeddings[self.word_map[emb_word]] = torch.from_numpy(embedded_word)
 
         self.embedding.weight = nn.Parameter(embeddings)
         
@@ -203,10 +239,11 @@ class CaptionEncoder(nn.Module):
     def forward(self, src, src_len):
         """
         src: the sentence to encode of shape (batch_size, seq_length) of type Long
-        src_len: long tensor that contains the lengths of each sentence in the batch of shape (batch_size, 1) of type Long
+        src_len: long tensor that contains the lengths of each sentence in the batch of shape (batch_size, 1) of type Long.
+                 Pass it on the CPU: pack_padded_sequence needs the lengths there, and a GPU tensor costs a sync
         """
         embedded = self.embed(src)  # (batch_size, seq_length, emb_dim)
-        src_len = src_len.squeeze(1).tolist()
+        src_len = src_len.squeeze(1).cpu()   # no-op for CPU lengths
         
         packed_embedded = pack_padded_sequence(embedded, 
                                                src_len, 
@@ -219,7 +256,8 @@ class CaptionEncoder(nn.Module):
         # outputs of shape (batch_size, seq_length, hidden_size * 2)
         outputs, _ = pad_packed_sequence(packed_outputs,
                                          batch_first=True) 
-        prev_cap_mask = ((outputs.sum(2))!=0).float()
+        # Additive attention mask: 0 for the words and -1e4 for the pads (-1e4 rather than -inf/-1e10 to be safe in bf16)
+        prev_cap_mask = ((outputs.sum(2)) == 0).float() * -1e4
         #outputs is now a non-packed sequence, all hidden states obtained when the input is a pad token are all zeros
         concat_hidden = torch.cat((hidden[0][-2,:,:], hidden[0][-1,:,:]), dim = 1)  # (batch_size, hidden_size * 2)
         final_hidden = torch.tanh(self.concat(concat_hidden))   # (batch_size, concat_output_dim)
@@ -237,15 +275,14 @@ class CaptionAttention(nn.Module):
     def forward(self, caption_features, decoder_hidden, prev_caption_mask):
         """
         caption features of shape: (batch_size, max_seq_length, hidden_size*2) (hidden_size = caption_features_dim)
-        prev_caption_mask of shape: (batch_size, max_seq_length)
+        prev_caption_mask of shape: (batch_size, max_seq_length), the additive mask computed in the CaptionEncoder
         decoder_hidden is the current output of the decoder LSTM of shape (batch_size, decoder_dim)
         text_chunk is the output of the word gating of shape (batch_size, 1024)
         """
         att1_c = self.cap_features_att(caption_features)  # (batch_size, max_words, attention_dim)
         att2_c = self.cap_decoder_att(decoder_hidden)  # (batch_size, attention_dim)
-        att_c = self.cap_full_att(torch.tanh(att1_c + att2_c.unsqueeze(1))).squeeze(2)  # (batch_size, max_words)
         # Masking for zero pads for attention computation
-        att_c = att_c.masked_fill(prev_caption_mask == 0, -1e10)   # (batch_size, max_words) * (batch_size, max_words)
+        att_c = self.cap_full_att(torch.tanh(att1_c + att2_c.unsqueeze(1))).squeeze(2) + prev_caption_mask  # (batch_size, max_words)
         alpha_c = F.softmax(att_c, dim = 1)  # (batch_size, max_words)
         
         context = (caption_features * alpha_c.unsqueeze(2)).sum(dim=1)  # (batch_size, caption_features_dim)
@@ -253,7 +290,43 @@ class CaptionAttention(nn.Module):
         return context
 
 
-class DAE(nn.Module):
+@torch.jit.script
+def fused_lstm_cell(x, h, c, w_ih, w_hh, b_ih, b_hh):
+    """
+    Same computation as nn.LSTMCell (gate order i, f, g, o), written out so that TorchScript (and torch.compile, 
+    which inlines it) can fuse the pointwise gate math into a single kernel. F.linear is used rather than 
+    addmm with w.t(), since torch.jit.freeze folds the transposed weight into a constant that breaks shape propagation
+    """
+    gates = F.linear(x, w_ih, b_ih) + F.linear(h, w_hh, b_hh)   # (batch_size, 4 * hidden_size)
+    i, f, g, o = gates.chunk(4, 1)
+    c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+    h = torch.sigmoid(o) * torch.tanh(c)
+    return h, c
+
+
+class DecoderStep(nn.Module):
+    """
+    The recurrent part of a decoding timestep, shared by DAE.step (training) and DAEInference (the frozen beam 
+    search decoder). Subclasses provide the embed, attention_lstm, caption_attention and language_lstm submodules
+    """
+    def step_states(self, it, final_hidden, h1, c1, h2, c2, previous_encoded, prev_cap_mask):
+        """
+        it: the previous words of shape (batch_size)
+        returns the new LSTM states h1, c1, h2, c2, each of shape (batch_size, decoder_dim)
+        """
+        embeddings = self.embed(it) 
+        topdown_input = torch.cat([embeddings,final_hidden, h2],dim=1)
+        # The LSTMCell modules are kept (for their parameters and existing checkpoints), but run through fused_lstm_cell
+        h1,c1 = fused_lstm_cell(topdown_input, h1, c1, self.attention_lstm.weight_ih, self.attention_lstm.weight_hh, 
+                                self.attention_lstm.bias_ih, self.attention_lstm.bias_hh)
+        attend_cap = self.caption_attention(previous_encoded, h1, prev_cap_mask)
+        language_input = torch.cat([h1, attend_cap], dim = 1)
+        h2,c2 = fused_lstm_cell(language_input, h2, c2, self.language_lstm.weight_ih, self.language_lstm.weight_hh, 
+                                self.language_lstm.bias_ih, self.language_lstm.bias_hh)
+        return h1, c1, h2, c2
+
+
+class DAE(DecoderStep):
 
     def __init__(self, 
                  word_map,  
@@ -278,39 +351,54 @@ class DAE(nn.Module):
         self.dropout = nn.Dropout(0.5)
         
     def init_hidden_state(self,batch_size):
-
-        h = torch.zeros(batch_size,self.decoder_dim).to(device)  # (batch_size, decoder_dim)
-        c = torch.zeros(batch_size,self.decoder_dim).to(device)
+        # Allocate on the model's device through the caching allocator (no host-side zeros + copy)
+        weight = self.fc.weight
+        h = weight.new_zeros(batch_size,self.decoder_dim)  # (batch_size, decoder_dim)
+        c = weight.new_zeros(batch_size,self.decoder_dim)
         return h, c
 
-    def forward(self, word_map, encoded_previous_captions, previous_cap_length, sample_max, sample_rl):
+    def encode(self, encoded_previous_captions, previous_cap_length):
         """
-        encoded captions of shape: (batch_size, max_caption_length)
-        caption_lengths of shape: (batch_size, 1)
         encoded_previous_captions: encoded previous captions to be passed to the LSTM encoder of shape: (batch_size, max_caption_length)
         previous_caption_lengths of shape: (batch_size, 1)
-        prev_caption_mask of shape (batch_size, max_words)
+        returns the encoder state (previous_encoded, final_hidden, prev_cap_mask) consumed by decode
         """
-        batch_size = encoded_previous_captions.size(0)
+        return self.caption_encoder(encoded_previous_captions, previous_cap_length)
+
+    def step(self, it, final_hidden, h1, c1, h2, c2, previous_encoded, prev_cap_mask):
+        """
+        One decoding timestep, shared by decode and the beam search in evaluate
+        it: the previous words of shape (batch_size)
+        returns the log probabilities of shape (batch_size, vocab_size) and the new LSTM states
+        """
+        h1, c1, h2, c2 = self.step_states(it, final_hidden, h1, c1, h2, c2, previous_encoded, prev_cap_mask)
+        pt = self.fc(self.dropout(h2)) 
+        logprobs = F.log_softmax(pt, dim=1)
+        return logprobs, h1, c1, h2, c2
+
+    def decode(self, encoded_state, word_map, sample_max, sample_rl, step_fn = None):
+        """
+        encoded_state: the output of encode, which can be shared between several decoding passes
+        step_fn: optional replacement for self.step with the same signature, e.g. a torch.compile'd version of it
+        previous_encoded of shape (batch_size, max_words, caption_features_dim * 2)
+        final_hidden of shape (batch_size, caption_features_dim * 2)
+        prev_caption_mask of shape (batch_size, max_words), additive (0 for words, -1e4 for pads)
+        """
+        previous_encoded, final_hidden, prev_cap_mask = encoded_state
+        batch_size = previous_encoded.size(0)
         max_len = 18
-        seq = torch.zeros(batch_size, max_len, dtype=torch.long).to(device)
-        seqLogprobs = torch.zeros(batch_size, max_len).to(device)
+        seq = previous_encoded.new_zeros(batch_size, max_len, dtype=torch.long)
+        seqLogprobs = previous_encoded.new_zeros(batch_size, max_len, dtype=torch.float)   # kept in fp32 under autocast
         start_idx = word_map['<start>']
-        it = torch.LongTensor(batch_size).to(device)   # (batch_size) 
-        it[:] = start_idx
+        it = previous_encoded.new_full((batch_size,), start_idx, dtype=torch.long)   # (batch_size) 
         h1, c1 = self.init_hidden_state(batch_size)  # (batch_size, decoder_dim)
         h2, c2 = self.init_hidden_state(batch_size)  # (batch_size, decoder_dim)
-        previous_encoded, final_hidden, prev_cap_mask = self.caption_encoder(encoded_previous_captions, previous_cap_length)
+        step_fn = step_fn or self.step
+        end_idx = word_map['<end>']
+        unfinished = previous_encoded.new_ones(batch_size, dtype=torch.bool)   # (batch_size)
         
         for timestep in range(max_len + 1):
-            embeddings = self.embed(it) 
-            topdown_input = torch.cat([embeddings,final_hidden, h2],dim=1)
-            h1,c1 = self.attention_lstm(topdown_input, (h1, c1))
-            attend_cap = self.caption_attention(previous_encoded, h1, prev_cap_mask)
-            language_input = torch.cat([h1, attend_cap], dim = 1)
-            h2,c2 = self.language_lstm(language_input, (h2, c2))
-            pt = self.fc(self.dropout(h2)) 
-            logprobs = F.log_softmax(pt, dim=1)
+            logprobs, h1, c1, h2, c2 = step_fn(it, final_hidden, h1, c1, h2, c2, previous_encoded, prev_cap_mask)
             
             if timestep == max_len:
                 break
@@ -325,25 +413,76 @@ class DAE(nn.Module):
                 sampleLogprobs = logprobs.gather(1, it) # gather the logprobs at sampled positions
                 it = it.view(-1).long() # flatten indices for saving in tensor
                 
-            # Replace <end> token (if there is) with 0. Otherwise, a lot to change in ruotianluo code
-            it = it.clone()
-            it[it == word_map['<end>']] = 0
-            
-            # If all batches predict the <end> token, then stop looping
-            if timestep == 0:
-                unfinished = it > 0
-            else:
-                unfinished = unfinished * (it > 0)
-                
-            it = it * unfinished.type_as(it)
+            # Replace <end> token (if there is) with 0. Otherwise, a lot to change in ruotianluo code. 
+            # Sequences that have already finished keep predicting 0
+            it = torch.where((it == end_idx) | ~unfinished, torch.zeros_like(it), it)
+            # Keep track of the sequences that have not predicted the <end> token yet
+            unfinished = unfinished & (it != 0)
             seq[:,timestep] = it
             seqLogprobs[:,timestep] = sampleLogprobs.view(-1)
-            
-            # quit loop if all sequences have finished
-            if unfinished.sum() == 0:
-                break
+            # No early exit once all sequences have finished: checking unfinished.sum() forces a GPU sync 
+            # every timestep, and the positions after <end> are masked out in RewardCriterion anyway
                 
         return seq, seqLogprobs
+
+    def forward(self, word_map, encoded_previous_captions, previous_cap_length, sample_max, sample_rl):
+        """
+        encoded_previous_captions: encoded previous captions to be passed to the LSTM encoder of shape: (batch_size, max_caption_length)
+        previous_caption_lengths of shape: (batch_size, 1)
+        """
+        encoded_state = self.encode(encoded_previous_captions, previous_cap_length)
+        return self.decode(encoded_state, word_map, sample_max, sample_rl)
+    
+class DAEInference(DecoderStep):
+    """
+    Inference-only view of a trained DAE used by the beam search. It shares the DAE submodules and runs 
+    the decoding step without dropout, so that it can be scripted and frozen by freeze_for_inference
+    """
+    def __init__(self, dae):
+        super(DAEInference, self).__init__()
+        
+        self.caption_encoder = dae.caption_encoder
+        self.embed = dae.embed
+        self.attention_lstm = dae.attention_lstm
+        self.caption_attention = dae.caption_attention
+        self.language_lstm = dae.language_lstm
+        self.fc = dae.fc
+        self.decoder_dim = dae.decoder_dim
+
+    @torch.jit.export
+    def encode(self, encoded_previous_captions, previous_cap_length):
+        return self.caption_encoder(encoded_previous_captions, previous_cap_length)
+
+    def forward(self, it, final_hidden, h1, c1, h2, c2, previous_encoded, prev_cap_mask):
+        """
+        Same as DAE.step, without the dropout before fc
+        """
+        h1, c1, h2, c2 = self.step_states(it, final_hidden, h1, c1, h2, c2, previous_encoded, prev_cap_mask)
+        logprobs = F.log_softmax(self.fc(h2), dim=1)
+        return logprobs, h1, c1, h2, c2
+    
+def freeze_for_inference(dae):
+    """
+    Script and freeze the encoder and the decoding step of a DAE. The weights are folded in as constants, 
+    so this has to be redone whenever the DAE is updated
+    """
+    dae.eval()
+    scripted = torch.jit.script(DAEInference(dae).eval())
+    frozen = torch.jit.freeze(scripted, preserved_attrs = ['encode', 'decoder_dim'])
+    
+    # Run a decoding step on dummy inputs, so that a module that freezes but cannot run fails here rather than 
+    # in the middle of the beam search. Twice, since the profiling executor only optimizes the graph after the first run
+    weight = dae.fc.weight
+    enc = dae.caption_encoder
+    with torch.inference_mode():
+        it = torch.zeros(2, dtype=torch.long, device=weight.device)
+        h = weight.new_zeros(2, dae.decoder_dim)
+        final_hidden = weight.new_zeros(2, enc.concat.out_features)
+        previous_encoded = weight.new_zeros(2, 3, enc.enc_hid_dim * 2)
+        prev_cap_mask = weight.new_zeros(2, 3)
+        for _ in range(2):
+            frozen(it, final_hidden, h, h, h, h, previous_encoded, prev_cap_mask)
+    return frozen
     
 class DAEWithAR(nn.Module):
     """
@@ -389,6 +528,8 @@ from pyciderevalcap.ciderD.ciderD import CiderD
 sys.path.append("coco-caption")
 
 CiderD_scorer = None
+# Background thread for the CPU-side ground-truth preprocessing, so that it overlaps with the GPU decoding
+cider_executor = ThreadPoolExecutor(max_workers = 1)
 
 def init_scorer(cached_tokens):
     global CiderD_scorer
@@ -398,31 +539,43 @@ def preprocess_gd(allcaps, word_map):
     """
     allcaps: Long tensor of shape (batch_size, 5, max_len)
     """
-    ground_truth = []
-    for j in range(allcaps.shape[0]):
-        # when training with RL, no need to sort the batches as we did in cross-entropy training, since we don't feed
-        # the ground truth encoded captions to the LSTM language model
-        img_caps = allcaps[j].tolist()   # list of length 5
-        img_captions = list(map(lambda c: [w for w in c if w not in {word_map['<start>'], word_map['<pad>']}], img_caps)) 
-        # 0 will get removed later in array_to_str
-        img_captions_z = list(map(lambda c:[w if w!=word_map['<end>'] else 0 for w in c], img_captions)) 
-        ground_truth.append(img_captions_z)
+    # when training with RL, no need to sort the batches as we did in cross-entropy training, since we don't feed
+    # the ground truth encoded captions to the LSTM language model
+    caps = allcaps.numpy().copy()   # (batch_size, 5, max_len)
+    # mark <start> and <pad> tokens for removal before replacing <end> with 0 (0 will get removed later in array_to_str)
+    caps[(caps == word_map['<start>']) | (caps == word_map['<pad>'])] = -1
+    caps[caps == word_map['<end>']] = 0
+    ground_truth = [[[w for w in c if w != -1] for c in img_caps] for img_caps in caps.tolist()]
     return ground_truth  # list of length batch_size, each element in this list contains the 5 captions in another list (3D list)
 
 def array_to_str(arr):
-    out = ''
-    for i in range(len(arr)):
-        out += str(arr[i]) + ' '
-        # If reached end token
-        if arr[i] == 0:   # not word_map['<end>']. Remember we replaced word_map['<end>'] with 0 in the sample function
-            break
-    return out.strip()
-
-def get_self_critical_reward(gen_result, greedy_res, ground_truth, cider_weight = 1):
-    
+    arr = np.asarray(arr)
+    if arr.size == 0:
+        return ''
+    # Keep everything up to and including the first 0 (not word_map['<end>']. Remember we replaced 
+    # word_map['<end>'] with 0 in the sample function)
+    z = np.argmax(arr == 0)
+    end = z + 1 if arr[z] == 0 else len(arr)
+    return ' '.join(arr[:end].astype(str).tolist())
+
+def get_gts(allcaps, word_map):
+    """
+    allcaps: Long tensor of shape (batch_size, 5, max_len) on the CPU
+    returns the ground truth captions of each image as strings, ready for the CiderD scorer
+    """
     # ground_truth is the 5 ground truth captions for a mini-batch, which can be aquired from the preprocess_gd function
     #[[c1, c2, c3, c4, c5], [c1, c2, c3, c4, c5],........]. Note that c is a caption placed in a list
     # len(ground_truth) = batch_size. Already duplicated the ground truth captions in dataloader
+    ground_truth = preprocess_gd(allcaps, word_map)
+    
+    gts = OrderedDict()
+    for i in range(len(ground_truth)):
+        gts[i] = [array_to_str(ground_truth[i][j]) for j in range(len(ground_truth[i]))]
+    return gts
+
+def get_self_critical_reward(gen_result, greedy_res, gts, cider_weight = 1):
+    
+    # gts is the output of get_gts for the same mini-batch
     
     batch_size = gen_result.size(0)  
     
@@ -437,10 +590,6 @@ def get_self_critical_reward(gen_result, greedy_res, ground_truth, cider_weight
     for i in range(batch_size):
         # change to string for evaluation purpose
         res[batch_size + i] = [array_to_str(greedy_res[i])]
-
-    gts = OrderedDict()
-    for i in range(len(ground_truth)):
-        gts[i] = [array_to_str(ground_truth[i][j]) for j in range(len(ground_truth[i]))]
     
     # 2 is because one is for the sampling and one for greedy decoding
     res_ = [{'image_id':i, 'caption': res[i]} for i in range(2 * batch_size)] 
@@ -462,152 +611,203 @@ def train(train_loader, dae_ar, criterion, dae_ar_optimizer, epoch, word_map):
 
     sum_rewards = 0
     count = 0
+    # Mini-batches decoded since the last optimizer step, waiting to be scored together:
+    # (seq_gen_host, greedy_res_host, gts_future, seq_gen, seqLogprobs)
+    pending = []
+    
+    dae_ar_optimizer.zero_grad()
 
     for i, (_, _, previous_caption, prev_caplen, allcaps) in enumerate(train_loader):
-        
-        samples = previous_caption.shape[0]
        
-        previous_caption = previous_caption.to(device)
-        prev_caplen = prev_caplen.to(device)
-
-        
-        dae_ar_optimizer.zero_grad()
-        dae_ar.eval()
-        with torch.no_grad():
-            greedy_res, _ = dae_ar(word_map, previous_caption, prev_caplen, sample_max = True, sample_rl = False)
-        dae_ar.train()
-        seq_gen, seqLogprobs = dae_ar(word_map, previous_caption, prev_caplen, sample_max = False, sample_rl = True)
-        ground_truth = preprocess_gd(allcaps, word_map)
-        rewards = get_self_critical_reward(seq_gen, greedy_res, ground_truth, cider_weight = 1)
-        loss = criterion(seqLogprobs, seq_gen, rewards.to(device))
-        
-        loss.backward()
+        previous_caption = previous_caption.to(device, non_blocking=True)
+        # prev_caplen stays on the CPU, where the caption encoder packs the sequences
+
+        
+        # Convert the ground truth to strings on the CPU while the GPU decodes
+        gts_future = cider_executor.submit(get_gts, allcaps, word_map)
+        
+        with torch.autocast(device_type = device.type, dtype = torch.bfloat16, enabled = use_bf16):
+            # The greedy baseline is encoded and decoded in eval mode (no dropout), as at test time. The encoder 
+            # state can't be shared with the sampling pass, which encodes in train mode
+            dae_ar.eval()
+            with torch.no_grad():
+                greedy_state = dae_ar.dae.encode(previous_caption, prev_caplen)
+                greedy_res, _ = dae_ar.dae.decode(greedy_state, word_map, sample_max = True, sample_rl = False, 
+                                                  step_fn = decoder_step)
+            dae_ar.train()
+            encoded_state = dae_ar.dae.encode(previous_caption, prev_caplen)
+            seq_gen, seqLogprobs = dae_ar.dae.decode(encoded_state, word_map, sample_max = False, sample_rl = True, 
+                                                     step_fn = decoder_step)
+        
+        # Copy both decoded sequences into pinned host buffers. They are only waited for when scoring
+        seq_gen_host = torch.empty(seq_gen.shape, dtype = seq_gen.dtype, pin_memory = seq_gen.is_cuda)
+        greedy_res_host = torch.empty(greedy_res.shape, dtype = greedy_res.dtype, pin_memory = greedy_res.is_cuda)
+        seq_gen_host.copy_(seq_gen, non_blocking=True)
+        greedy_res_host.copy_(greedy_res, non_blocking=True)
+        pending.append((seq_gen_host, greedy_res_host, gts_future, seq_gen, seqLogprobs))
+        
+        if len(pending) < cider_batches and i + 1 < len(train_loader):
+            continue
+        
+        # Score all the pending mini-batches with a single CiderD call
+        if seq_gen.is_cuda:
+            torch.cuda.current_stream().synchronize()
+        sizes = [p[0].size(0) for p in pending]
+        gts = OrderedDict()
+        for p in pending:
+            for caps in p[2].result().values():
+                gts[len(gts)] = caps
+        rewards = get_self_critical_reward(torch.cat([p[0] for p in pending]), torch.cat([p[1] for p in pending]), 
+                                           gts, cider_weight = 1)
+        
+        # The gradients of the pending mini-batches are accumulated into a single optimizer step
+        for (_, _, _, seq_gen, seqLogprobs), mb_rewards in zip(pending, rewards.split(sizes)):
+            loss = criterion(seqLogprobs, seq_gen, mb_rewards.to(device, non_blocking=True)) / len(pending)
+            loss.backward()
         torch.nn.utils.clip_grad_norm_(filter(lambda p: p.requires_grad, dae_ar.parameters()), 0.25)
         dae_ar_optimizer.step()
+        dae_ar_optimizer.zero_grad()
+        pending = []
         
-        sum_rewards += torch.mean(rewards[:,0]) * samples
-        count += samples
+        sum_rewards += torch.sum(rewards[:,0])
+        count += rewards.size(0)
         
         # Print status
-        if i % print_freq == 0:
+        if (i // cider_batches) % print_freq == 0:
             print('Epoch: [{}][{}/{}]\tAverage Reward: {:.3f}'.format(epoch, i, len(train_loader), sum_rewards/count))
 
 
-def evaluate(loader, dae_ar, beam_size, epoch, word_map):
-    
+@torch.inference_mode()   # no autograd bookkeeping for the beam search
+def beam_search(loader, dae, beam_size, word_map):
+    """
+    Beam search over a batch of images at once. Every image keeps beam_size rows, so the decoder runs on 
+    (batch_size * beam_size) rows. Beams that are completed or dropped are kept in place with a score of -inf.
+    dae: the frozen module returned by freeze_for_inference
+    returns the list of {"image_id", "caption"} results for the images in loader
+    """
     vocab_size = len(word_map)
-    dae_ar.eval()
+    decoder_dim = dae.decoder_dim
+    end_idx = word_map['<end>']
     results = []
-    rev_word_map = {v: k for k, v in word_map.items()}
+    # Index -> word lookup table, indexed with the whole sequence at once when constructing sentences
+    rev_word_arr = np.empty(len(word_map), dtype=object)
+    for word, idx in word_map.items():
+        rev_word_arr[idx] = word
+    special_idx = [word_map['<start>'], word_map['<end>'], word_map['<pad>']]
     
-    # For each image
+    # For each batch of images
     for i, (image_id, previous_caption, prev_caplen) in enumerate(tqdm(loader, desc="EVALUATING AT BEAM SIZE " + str(beam_size))):
 
         k = beam_size
-        infinite_pred = False
+        num_images = previous_caption.size(0)
 
         # Move to GPU device, if available
-        encoded_previous_captions = previous_caption.to(device) 
-        prev_caplen = prev_caplen.to(device) 
-        image_id = image_id.to(device)  # (1,1)
+        encoded_previous_captions = previous_caption.to(device, non_blocking=True) 
+        # prev_caplen stays on the CPU, where the caption encoder packs the sequences
         
-        previous_encoded, final_hidden, prev_caption_mask = dae_ar.dae.caption_encoder(encoded_previous_captions, prev_caplen)
+        previous_encoded, final_hidden, prev_caption_mask = dae.encode(encoded_previous_captions, prev_caplen)
         
-        # Expand all
-        previous_encoded = previous_encoded.expand(k, -1, -1)
-        prev_cap_mask = prev_caption_mask.expand(k, -1)
-        final_hidden = final_hidden.expand(k,-1)
+        # Expand all to (num_images * k). The beams of an image never leave its rows, so these are not reordered
+        previous_encoded = previous_encoded.repeat_interleave(k, dim=0)
+        prev_cap_mask = prev_caption_mask.repeat_interleave(k, dim=0)
+        final_hidden = final_hidden.repeat_interleave(k, dim=0)
         
         # Tensor to store top k previous words at each step; now they're just <start>
-        k_prev_words = torch.LongTensor([[word_map['<start>']]] * k).to(device)  # (k, 1)
+        k_prev_words = final_hidden.new_full((num_images * k,), word_map['<start>'], dtype=torch.long)  # (num_images * k)
 
         # Tensor to store top k sequences; now they're just <start>
-        seqs = k_prev_words  # (k, 1)
+        seqs = k_prev_words.unsqueeze(1)  # (num_images * k, 1)
 
-        # Tensor to store top k sequences' scores; now they're just 0
-        top_k_scores = torch.zeros(k, 1).to(device)  # (k, 1)
+        # Tensor to store top k sequences' scores. For the first step, all k beams are the same (same previous 
+        # words, h, c), so only the first beam of each image is allowed to expand
+        top_k_scores = final_hidden.new_full((num_images, k), float('-inf'))  # (num_images, k)
+        top_k_scores[:, 0] = 0
 
-        # Lists to store completed sequences and scores
-        complete_seqs = list()
-        complete_seqs_scores = list()
+        # Number of beams still alive for each image, reduced as sequences hit <end>
+        live_beams = [k] * num_images
+        live_beams_t = final_hidden.new_full((num_images, 1), k, dtype=torch.long)
+        beam_rank = torch.arange(k, device=final_hidden.device).unsqueeze(0)   # (1, k)
+        image_offset = (torch.arange(num_images, device=final_hidden.device) * k).unsqueeze(1)   # (num_images, 1)
+
+        # Lists to store completed sequences and scores for each image
+        complete_seqs = [list() for _ in range(num_images)]
+        complete_seqs_scores = [list() for _ in range(num_images)]
 
         # Start decoding
-        step = 1
-        h1, c1 = dae_ar.dae.init_hidden_state(k)  # (batch_size, decoder_dim)
-        h2, c2 = dae_ar.dae.init_hidden_state(k)
-
-        # s is a number less than or equal to k, because sequences are removed from this process once they hit <end>
-        while True:
-
-            embeddings = dae_ar.dae.embed(k_prev_words).squeeze(1)        
-            topdown_input = torch.cat([embeddings, final_hidden, h2],dim=1)
-            h1,c1 = dae_ar.dae.attention_lstm(topdown_input, (h1, c1))
-            attend_cap = dae_ar.dae.caption_attention(previous_encoded, h1, prev_cap_mask)
-            language_input = torch.cat([h1, attend_cap], dim = 1)
-            h2,c2 = dae_ar.dae.language_lstm(language_input, (h2, c2))
-            scores = dae_ar.dae.fc(h2)  
-            scores = F.log_softmax(scores, dim=1)
+        h1, c1 = final_hidden.new_zeros(num_images * k, decoder_dim), final_hidden.new_zeros(num_images * k, decoder_dim)
+        h2, c2 = final_hidden.new_zeros(num_images * k, decoder_dim), final_hidden.new_zeros(num_images * k, decoder_dim)
+
+        for step in range(1, 52):
+
+            scores, h1, c1, h2, c2 = dae(k_prev_words, final_hidden, h1, c1, h2, c2, 
+                                         previous_encoded, prev_cap_mask)  # (num_images * k, vocab_size)
 
             # Add
-            scores = top_k_scores.expand_as(scores) + scores  # (s, vocab_size)
+            scores = top_k_scores.view(-1, 1) + scores  # (num_images * k, vocab_size)
 
-            # For the first step, all k points will have the same scores (since same k previous words, h, c)
-            if step == 1:
-                top_k_scores, top_k_words = scores[0].topk(k, 0, True, True)  # (s)
-            else:
-                # Unroll and find top scores, and their unrolled indices
-                top_k_scores, top_k_words = scores.view(-1).topk(k, 0, True, True)  # (s)
+            # Unroll the beams of each image and find top scores, and their unrolled indices
+            top_k_scores, top_k_words = scores.view(num_images, -1).topk(k, 1, True, True)  # (num_images, k)
 
             # Convert unrolled indices to actual indices of scores
-            prev_word_inds = top_k_words / vocab_size  # (s)
-            next_word_inds = top_k_words % vocab_size  # (s)
+            prev_word_inds = torch.div(top_k_words, vocab_size, rounding_mode='floor') + image_offset  # (num_images, k)
+            next_word_inds = top_k_words % vocab_size  # (num_images, k)
 
             # Add new words to sequences
-            seqs = torch.cat([seqs[prev_word_inds], next_word_inds.unsqueeze(1)], dim=1)  # (s, step+1)
-
-            # Which sequences are incomplete (didn't reach <end>)?
-            incomplete_inds = [ind for ind, next_word in enumerate(next_word_inds) if next_word != word_map['<end>']]
-            complete_inds = list(set(range(len(next_word_inds))) - set(incomplete_inds))
+            prev_word_inds = prev_word_inds.view(-1)
+            seqs = torch.cat([seqs[prev_word_inds], next_word_inds.view(-1, 1)], dim=1)  # (num_images * k, step+1)
+            h1 = h1[prev_word_inds]
+            c1 = c1[prev_word_inds]
+            h2 = h2[prev_word_inds]
+            c2 = c2[prev_word_inds]
+            k_prev_words = next_word_inds.view(-1)
+
+            # Only the top live_beams of each image are kept. Which of them are complete (reached <end>)?
+            selected = beam_rank < live_beams_t   # (num_images, k)
+            complete = selected & (next_word_inds == end_idx)
 
             # Set aside complete sequences
+            complete_inds = complete.view(-1).nonzero(as_tuple=True)[0].tolist()
             if len(complete_inds) > 0:
-                complete_seqs.extend(seqs[complete_inds].tolist())
-                complete_seqs_scores.extend(top_k_scores[complete_inds])
-            k -= len(complete_inds)  # reduce beam length accordingly
-
-            # Proceed with incomplete sequences
-            if k == 0:
+                completed = seqs[complete_inds].tolist()
+                completed_scores = top_k_scores.view(-1)[complete_inds].tolist()
+                for ind, seq, score in zip(complete_inds, completed, completed_scores):
+                    complete_seqs[ind // k].append(seq)
+                    complete_seqs_scores[ind // k].append(score)
+                    live_beams[ind // k] -= 1  # reduce beam length accordingly
+            live_beams_t = live_beams_t - complete.sum(1, keepdim=True)
+
+            if max(live_beams) == 0:
                 break
                 
-            seqs = seqs[incomplete_inds]
-            h1 = h1[prev_word_inds[incomplete_inds]]
-            c1 = c1[prev_word_inds[incomplete_inds]]
-            h2 = h2[prev_word_inds[incomplete_inds]]
-            c2 = c2[prev_word_inds[incomplete_inds]]
-            previous_encoded = previous_encoded[prev_word_inds[incomplete_inds]]
-            prev_cap_mask = prev_cap_mask[prev_word_inds[incomplete_inds]]
-            final_hidden = final_hidden[prev_word_inds[incomplete_inds]]
-            top_k_scores = top_k_scores[incomplete_inds].unsqueeze(1)
-            k_prev_words = next_word_inds[incomplete_inds].unsqueeze(1)
-
-            # Break if things have been going on too long
-            if step > 50:
-                infinite_pred = True
-                break
-            step += 1
+            # Proceed with incomplete sequences; the others can no longer be expanded
+            top_k_scores = top_k_scores.masked_fill(~selected | complete, float('-inf'))
 
-        if infinite_pred is not True:
-            i = complete_seqs_scores.index(max(complete_seqs_scores))
-            seq = complete_seqs[i]
-        else:
-            seq = seqs[0][:18]
-            seq = [seq[i].item() for i in range(len(seq))]
+        # Break if things have been going on too long: images that still have live beams take their best one
+        best_live = top_k_scores.argmax(1).tolist()
+        seqs = seqs.view(num_images, k, -1)
+
+        for j in range(num_images):
+            if live_beams[j] == 0:
+                best = complete_seqs_scores[j].index(max(complete_seqs_scores[j]))
+                seq = complete_seqs[j][best]
+            else:
+                seq = seqs[j, best_live[j], :18].tolist()
             
-        # Construct Sentence
-        sen_idx = [w for w in seq if w not in {word_map['<start>'], word_map['<end>'], word_map['<pad>']}]
-        sentence = ' '.join([rev_word_map[sen_idx[i]] for i in range(len(sen_idx))])
-        item_dict = {"image_id": image_id.item(), "caption": sentence}
-        results.append(item_dict)
+            # Construct Sentence
+            seq = np.asarray(seq, dtype=np.int64)
+            sen_idx = seq[~np.isin(seq, special_idx)]
+            sentence = ' '.join(rev_word_arr[sen_idx].tolist())
+            item_dict = {"image_id": image_id[j].item(), "caption": sentence}
+            results.append(item_dict)
+        
+    return results
+
+
+def evaluate(loader, dae_ar, beam_size, epoch, word_map):
+    
+    dae_ar.eval()
+    # Run the beam search on a scripted and frozen copy of the current weights
+    results = beam_search(loader, freeze_for_inference(dae_ar.dae), beam_size, word_map)
         
     print("Calculating Evalaution Metric Scores......\n")
     resFile = 'cococaption/results/captions_val2014_results_' + str(epoch) + '.json' 
@@ -634,12 +834,19 @@ def evaluate(loader, dae_ar, beam_size, epoch, word_map):
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 cudnn.benchmark = True  # set to true only if inputs to model are fixed size; otherwise lot of computational overhead
+use_bf16 = device.type == 'cuda' and torch.cuda.get_device_capability() >= (8, 0)  # bf16 autocast (native on Ampere and newer)
+compile_decoder = device.type == 'cuda' and hasattr(torch, 'compile')  # fuse the per-timestep decoder graph with TorchInductor
 start_epoch = 0
 epochs = 50  # number of epochs to train for (if early stopping is not triggered)
 epochs_since_improvement = 0  # keeps track of number of epochs since there's been an improvement in validation BLEU
 batch_size = 60
+eval_batch_size = 16  # number of images decoded together in the beam search
 best_cider = 0.
 print_freq = 100  # print training/validation stats every __ batches
+# Number of mini-batches scored with a single CiderD call. Values above 1 also accumulate them into one optimizer step 
+# (effective batch of cider_batches * batch_size with the same lr and clipping), so 1 keeps the usual SCST schedule
+cider_batches = 1
+workers = min(8, os.cpu_count() or 1)  # for data-loading; the memory-mapped caption arrays are shared with the workers
 checkpoint = 'dcnet.tar' # path to checkpoint, None if none
 annFile = 'cococaption/annotations/captions_val2014.json'  # Location of validation annotations
 emb_file = 'glove.6B.300d.txt'
@@ -661,6 +868,11 @@ dae_ar = checkpoint['dae_ar']
 dae_ar_optimizer = checkpoint['dae_ar_optimizer']
 
 dae_ar = dae_ar.to(device)
+optimizer_to(dae_ar_optimizer, device)
+
+# Only the decoding step is compiled: it has no sample_max/sample_rl branches, so the greedy and the sampling 
+# passes share the compiled graph, and the pickled dae_ar in the checkpoints stays a plain nn.Module
+decoder_step = torch.compile(dae_ar.dae.step) if compile_decoder else None
 
 for param in dae_ar.affine_hidden.parameters():
     param.requires_grad = False
@@ -673,12 +885,18 @@ criterion = RewardCriterion().to(device)
 train_loader = torch.utils.data.DataLoader(COCOTrainDataset(),
                                            batch_size = batch_size, 
                                            shuffle=True, 
-                                           pin_memory=True)
+                                           pin_memory=True,
+                                           num_workers = workers,
+                                           persistent_workers = True,
+                                           prefetch_factor = 2)
 
 val_loader = torch.utils.data.DataLoader(COCOValidationDataset(),
-                                         batch_size = 1,
+                                         batch_size = eval_batch_size,
                                          shuffle=True, 
-                                         pin_memory=True)
+                                         pin_memory=True,
+                                         num_workers = workers,
+                                         persistent_workers = True,
+                                         prefetch_factor = 2)
 
 # Epochs
 for epoch in range(start_epoch, epochs):
@@ -719,3 +937,7 @@ for epoch in range(start_epoch, epochs):
     save_checkpoint(epoch, epochs_since_improvement, dae_ar, dae_ar_optimizer, recent_cider, is_best)
 
 
+
+# Wait for the last checkpoint to be written
+if checkpoint_future is not None:
+    checkpoint_future.result()
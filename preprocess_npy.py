@@ -0,0 +1,38 @@
+import os
+import json
+import numpy as np
+
+# Converts the training caption data used by dcnet_rl.py into flat .npy arrays, which the dataset
+# memory-maps instead of parsing the JSON files. All DataLoader workers then share the same pages.
+output_folder = 'caption data'
+
+with open(os.path.join(output_folder, 'TRAIN_CAPTIONS_coco.json'), 'r') as j:
+    captions = json.load(j)
+
+with open(os.path.join(output_folder, 'TRAIN_CAPLENS_coco.json'), 'r') as j:
+    caplens = json.load(j)
+
+with open(os.path.join(output_folder, 'TRAIN_names_coco.json'), 'r') as j:
+    names = json.load(j)
+
+with open(os.path.join(output_folder, 'CAPUTIL_train.json'), 'r') as j:
+    caption_util = json.load(j)
+
+with open(os.path.join(output_folder, 'WORDMAP_coco.json'), 'r') as j:
+    word_map = json.load(j)
+
+# int16 is enough for both the word indices and the lengths
+assert max(word_map.values()) <= np.iinfo(np.int16).max
+
+# Previous captions are stored in the same order as the image names (row N is the image of captions 5N to 5N+4)
+prev_caps = [caption_util[name]['encoded_previous_caption'] for name in names]
+prev_max_len = max(len(c) for c in prev_caps)
+prev_caps_arr = np.zeros((len(names), prev_max_len), dtype=np.int16)   # padded with <pad> (0)
+for i, c in enumerate(prev_caps):
+    prev_caps_arr[i, :len(c)] = c
+prev_caplens_arr = np.asarray([caption_util[name]['previous_caption_length'] for name in names], dtype=np.int16)
+
+np.save(os.path.join(output_folder, 'TRAIN_CAPTIONS_coco.npy'), np.asarray(captions, dtype=np.int16))
+np.save(os.path.join(output_folder, 'TRAIN_CAPLENS_coco.npy'), np.asarray(caplens, dtype=np.int16))
+np.save(os.path.join(output_folder, 'TRAIN_PREVCAPS_coco.npy'), prev_caps_arr)
+np.save(os.path.join(output_folder, 'TRAIN_PREVCAPLENS_coco.npy'), prev_caplens_arr)